@@ -40,8 +40,14 @@ def get_default_parser():
     parser.add_argument(
         '--accumulate_grad_batches',
         type=int,
-        default=1,
-        help='Accumulates grads every k batches or as set up in the dict.',
+        default=None,
+        help='Accumulates grads every k batches. Default: effective_batch_size // batch_size, or 1.',
+    )
+    parser.add_argument(
+        '--effective_batch_size',
+        type=int,
+        default=None,
+        help='Target number of samples per optimizer step, reached by accumulating gradients over batches.',
     )
     parser.add_argument('--gpus', type=int, default=0, help="How many GPUs to train on")
     parser.add_argument(
@@ -50,7 +56,13 @@ def get_default_parser():
         default="auto",
         help="The training strategy to use e.g. ddp",
     )
-    parser.add_argument('--precision', type=int, default=32, help="Full precision (32), half precision (16).")
+    parser.add_argument(
+        '--precision',
+        type=str,
+        default=None,
+        help='Trainer precision, e.g. 32, 16-mixed or bf16-mixed. '
+        'Default: bf16-mixed on GPUs that support it, 16-mixed on other GPUs and 32 on CPU.',
+    )
     parser.add_argument('--num_nodes', type=int, default=1, help="Number of GPU nodes for distributed training")
     parser.add_argument('--masked_lm', default=1, type=int, help='Whether to use the masked lm task.')
     parser.add_argument('--tiny', action='store_true', help='Tiny model for debugging')
@@ -84,6 +96,11 @@ def get_default_parser():
         help='If set to 1: runs 1 batch of train, test and val to find any bugs ' '(ie: a sort of unit test).',
     )
     parser.add_argument('--seed', default=42, type=int, help='Seed for random initialisation')
+    parser.add_argument(
+        '--test_int8',
+        action='store_true',
+        help='Quantize the BERT backbone to int8 before testing. Needs torchao on a GPU.',
+    )
 
     return parser
 
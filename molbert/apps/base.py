@@ -1,4 +1,5 @@
 import logging
+import pickle
 import pprint
 from abc import ABC
 from argparse import ArgumentParser, Namespace
@@ -7,7 +8,7 @@ import torch
 from pytorch_lightning import Trainer, seed_everything
 from pytorch_lightning.callbacks import LearningRateMonitor
 from pytorch_lightning.callbacks import ModelCheckpoint
-from pytorch_lightning.loggers import WandbLogger
+from pytorch_lightning.utilities.rank_zero import rank_zero_only
 
 from molbert.apps.args import get_default_parser
 from molbert.models.base import MolbertModel
@@ -24,27 +25,32 @@ class BaseMolbertApp(ABC):
         See: https://github.com/PyTorchLightning/pytorch-lightning/issues/525
         """
         logger.info(f'Loading model weights from {checkpoint_file}')
-        checkpoint = torch.load(checkpoint_file, map_location=lambda storage, loc: storage)
+        try:
+            # memory map the checkpoint instead of reading all of it into host memory
+            checkpoint = torch.load(checkpoint_file, map_location='cpu', mmap=True, weights_only=True)
+        except (pickle.UnpicklingError, RuntimeError) as e:
+            # legacy (non zip) checkpoints can't be memory mapped and checkpoints storing
+            # hyperparameters as custom objects can't be loaded with weights_only
+            logger.warning(f'Falling back to fully loading the checkpoint: {e}')
+            checkpoint = torch.load(checkpoint_file, map_location='cpu', weights_only=False)
 
         # load weights from checkpoint, strict=False allows to ignore some weights
         # e.g. weights of a head that was used during pretraining but isn't present during finetuning
         # and also allows to missing keys in the checkpoint, e.g. heads that are used for finetuning
-        # but weren't present during pretraining
-        model.load_state_dict(checkpoint['state_dict'], strict=False)
+        # but weren't present during pretraining.
+        # If the model is still on the cpu the loaded tensors are assigned instead of copied into the parameters.
+        model.load_state_dict(checkpoint['state_dict'], strict=False, assign=model.device.type == 'cpu')
         return model
 
     def run(self, args=None):
         args = self.parse_args(args)
         seed_everything(args.seed)
+        self.configure_backends(args)
 
-        pprint.pprint('args')
-        pprint.pprint(args.__dict__)
-        pprint.pprint('*********************')
+        logger.info(f'args:\n{pprint.pformat(vars(args))}')
 
         checkpoint_callback = ModelCheckpoint(monitor='valid_loss', verbose=True, save_last=True)
 
-        logger.info(args)
-
         lr_logger = LearningRateMonitor()
 
         trainer = Trainer(
@@ -60,7 +66,7 @@ class BaseMolbertApp(ABC):
             accumulate_grad_batches=args.accumulate_grad_batches,
             fast_dev_run=args.fast_dev_run,
             callbacks=[lr_logger, checkpoint_callback],
-            logger=WandbLogger() if args.wandb else None
+            logger=self.get_logger(args),
         )
 
         model = self.get_model(args)
@@ -72,13 +78,62 @@ class BaseMolbertApp(ABC):
 
         return trainer
 
+    @staticmethod
+    def get_logger(args):
+        """
+        Only rank zero logs to Weights and Biases, other ranks would log in and open a run for nothing.
+        The rank is known from the environment before the Trainer exists.
+        """
+        # rank is set as an attribute on the rank_zero_only decorator at import time
+        if not getattr(args, 'wandb', False) or getattr(rank_zero_only, 'rank', 0) != 0:
+            return None
+
+        # imported lazily since it pulls in wandb
+        from pytorch_lightning.loggers import WandbLogger
+
+        return WandbLogger()
+
+    @staticmethod
+    def configure_backends(args):
+        """
+        Enables TF32 matmuls for full precision training on Ampere+ GPUs, mixed precision
+        runs already use half precision tensor cores. The cuDNN autotuner is only enabled
+        when the run doesn't need to be deterministic.
+        """
+        if str(args.precision) in ('32', '32-true'):
+            torch.set_float32_matmul_precision('high')
+            torch.backends.cuda.matmul.allow_tf32 = True
+
+        torch.backends.cudnn.benchmark = not args.deterministic
+
     def parse_args(self, args) -> Namespace:
         """
         Parse command line arguments
         """
         parser = get_default_parser()
         parser = self.add_parser_arguments(parser)
-        return parser.parse_args(args=args)
+        parsed_args = parser.parse_args(args=args)
+
+        if parsed_args.precision is None:
+            parsed_args.precision = self.get_default_precision()
+
+        if parsed_args.accumulate_grad_batches is None:
+            effective_batch_size = parsed_args.effective_batch_size or parsed_args.batch_size
+            parsed_args.accumulate_grad_batches = max(1, effective_batch_size // parsed_args.batch_size)
+
+        return parsed_args
+
+    @staticmethod
+    def get_default_precision() -> str:
+        """
+        Picks mixed precision when training on a GPU: bf16 needs no grad scaling,
+        fp16 is scaled automatically by Lightning when using '16-mixed'.
+        """
+        if not torch.cuda.is_available():
+            return '32'
+
+        # emulated bf16 (e.g. on V100 and T4) is slower than fp16
+        return 'bf16-mixed' if torch.cuda.is_bf16_supported(including_emulation=False) else '16-mixed'
 
     @staticmethod
     def get_model(args) -> MolbertModel:
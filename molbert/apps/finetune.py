@@ -1,5 +1,5 @@
+import logging
 import os
-import pprint
 from argparse import ArgumentParser, Namespace
 
 import yaml
@@ -8,18 +8,19 @@ from molbert.apps.base import BaseMolbertApp
 from molbert.models.base import MolbertModel
 from molbert.models.finetune import FinetuneSmilesMolbertModel
 
+logger = logging.getLogger(__name__)
+
 
 class FinetuneSmilesMolbertApp(BaseMolbertApp):
     @staticmethod
     def get_model(args) -> MolbertModel:
-        pprint.pprint(args)
+        # args and the model are logged by BaseMolbertApp.run
         model = FinetuneSmilesMolbertModel(args)
-        pprint.pprint(model)
 
         model = BaseMolbertApp.load_model_weights(model=model, checkpoint_file=args.pretrained_model_path)
 
         if args.freeze_level != 0:
-            print('Freezing base model')
+            logger.info('Freezing base model')
             FinetuneSmilesMolbertApp.freeze_network(model, args.freeze_level)
 
         return model
@@ -118,6 +119,12 @@ class FinetuneSmilesMolbertApp(BaseMolbertApp):
             required=True,
             help='Number of task output dimensions. 1 for regression, n_classes for classification',
         )
+        parser.add_argument(
+            '--token_cache_dir',
+            type=str,
+            default=None,
+            help='Directory to cache the tokenized datasets in. Tokenization is redone every epoch if not set.',
+        )
         parser.add_argument(
             "--wandb",
             action="store_true",
@@ -5,15 +5,32 @@ import torch
 from torch.utils.data import DataLoader
 
 
+def collate_prebatched(batch):
+    """
+    Passes through a batch that the dataset's __getitems__ already collated
+    """
+    return batch
+
+
 class MolbertDataLoader(DataLoader):
     """
     A custom data loader that does some molbert specific things.
     1) it skips invalid batches and replaces them with oversampled valid batches such that always n_batches are
        created.
     2) it does the valid filtering and trimming in the workers
+    3) it pins memory when a GPU is available and keeps prefetching workers alive across epochs
     """
 
     def __init__(self, *args, **kwargs):
+        # defaults are only added when the loader options are given by keyword, so they never clash with positionals
+        if len(args) <= 1:
+            kwargs.setdefault('pin_memory', torch.cuda.is_available())
+
+            # both options are only valid with multiprocessing
+            if kwargs.get('num_workers', 0) > 0:
+                kwargs.setdefault('persistent_workers', True)
+                kwargs.setdefault('prefetch_factor', 4)
+
         super().__init__(*args, **kwargs)
         # See dataloader.pyi for examplanation of type: ignore
         self.collate_fn = self.wrapped_collate_fn(self.collate_fn)  # type: ignore
@@ -1,4 +1,6 @@
+import hashlib
 import logging
+import os
 from typing import List, Optional, Tuple, Union
 
 import pandas as pd
@@ -18,6 +20,7 @@ class BertFinetuneSmilesDataset(BaseBertDataset):
         total_seq_len,
         label_column,
         permute=False,
+        cache_dir: Optional[str] = None,
         *args,
         **kwargs,
     ):
@@ -26,6 +29,112 @@ class BertFinetuneSmilesDataset(BaseBertDataset):
         data = pd.read_csv(input_path)
         self.labels = data[label_column]
 
+        # unmasked token ids of shape (N, total_seq_len), all-zero rows mark invalid samples.
+        # Permuted SMILES change on every access so they can't be cached.
+        self.token_ids: Optional[torch.Tensor] = None
+        if cache_dir is not None and not permute:
+            self.token_ids = self.load_token_ids(cache_dir)
+
+    def load_token_ids(self, cache_dir: str) -> torch.Tensor:
+        """
+        Loads the tokenized dataset from cache_dir, tokenizing and saving it first if there is no up to date cache.
+        The cache is memory mapped, so loading it for every dataset and worker is cheap.
+        """
+        # the hash of the full path keeps files with the same name in different directories apart
+        path_hash = hashlib.md5(os.path.abspath(self.sequence_file).encode()).hexdigest()[:8]
+        file_name = os.path.basename(self.sequence_file)
+        cache_path = os.path.join(cache_dir, f'{file_name}.{path_hash}.{self.total_seq_len}.tok.pt')
+
+        if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(self.sequence_file):
+            logger.info(f'Tokenizing {self.sequence_file} into {cache_path}')
+            token_ids = self.tokenize_all()
+
+            # write to a temporary file first, so that concurrent processes never read a partial cache
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            torch.save(token_ids, tmp_path)
+            os.replace(tmp_path, cache_path)
+
+        return torch.load(cache_path, mmap=True, weights_only=True)
+
+    def tokenize_all(self) -> torch.Tensor:
+        token_ids = torch.zeros((len(self), self.total_seq_len), dtype=torch.int32)
+
+        for index in range(len(self)):
+            t1, _, _, valid = self.get_sample(index)
+            if not valid:
+                continue
+
+            tokens = [self.featurizer.begin, *self.featurizer.encode(t1), self.featurizer.end]
+            if len(tokens) > self.total_seq_len:
+                logger.warning(f'Tokenized SMILES is longer than {self.total_seq_len}, marking it invalid: {t1}')
+                continue
+
+            token_ids[index, : len(tokens)] = torch.tensor(self.featurizer.convert_tokens_to_ids(tokens))
+
+        return token_ids
+
+    def __getitem__(self, index):
+        if self.token_ids is None:
+            return super().__getitem__(index)
+
+        self.sample_counter += 1
+        token_ids = self.token_ids[index].long()
+        length = int((token_ids != self.featurizer.pad_idx).sum())
+
+        if length == 0:
+            return self.get_invalid_sample(), False  # not valid
+
+        if not self.inference_mode:
+            # masking is random, so it is redone on the cached tokens of every access
+            tokens = [self.featurizer.idx_to_token[i] for i in token_ids[1:length - 1].tolist()]
+            return self.prepare_encoded_sample(index, tokens), True  # valid
+
+        labels = torch.tensor(self.labels[index], dtype=torch.float).unsqueeze(0)
+        return self.get_cached_features(token_ids, labels), True  # valid
+
+    def __getitems__(self, indices: List[int]):
+        """
+        Called by the DataLoader with all indices of a batch. With a token cache in inference mode the batch
+        is returned already collated, otherwise as the list of its samples like the default fetching does.
+        """
+        if self.token_ids is None or not self.inference_mode:
+            return [self[index] for index in indices]
+
+        return self.get_batch(indices)
+
+    def get_batch(self, indices: List[int]):
+        """
+        Returns an already collated inference batch, sliced out of the token cache with a single index_select
+        instead of building and stacking every sample. Invalid samples are flagged in valids as usual.
+        """
+        assert self.token_ids is not None and self.inference_mode, 'Batched access needs a token cache and inference_mode'
+
+        self.sample_counter += len(indices)
+        token_ids = self.token_ids.index_select(0, torch.tensor(indices)).long()
+        labels = torch.as_tensor(self.labels.values[indices], dtype=torch.float).unsqueeze(1)
+        valids = token_ids[:, 0] != self.featurizer.pad_idx
+
+        return self.get_cached_features(token_ids, labels), valids
+
+    def get_cached_features(self, token_ids: torch.Tensor, finetune_labels: torch.Tensor):
+        """
+        Without masking the features of a sample (or batch) are just its cached tokens
+        """
+        inputs = dict(
+            input_ids=token_ids,
+            token_type_ids=torch.zeros_like(token_ids),
+            attention_mask=(token_ids != self.featurizer.pad_idx).long(),
+        )
+
+        labels = dict(
+            lm_label_ids=torch.full_like(token_ids, -1),
+            unmasked_lm_label_ids=token_ids.clone(),
+            finetune=finetune_labels,
+        )
+
+        return inputs, labels
+
     @staticmethod
     def load_sequences(sequence_file):
         data = pd.read_csv(sequence_file)
@@ -71,7 +180,11 @@ class BertFinetuneSmilesDataset(BaseBertDataset):
 
         encoded_tokens_a = list(self.featurizer.encode(t1))
 
-        inputs, labels = super().prepare_sample(cur_id, encoded_tokens_a, None, is_same)
+        return self.prepare_encoded_sample(cur_id, encoded_tokens_a)
+
+    def prepare_encoded_sample(self, cur_id: int, encoded_tokens: List[str]):
+
+        inputs, labels = super().prepare_sample(cur_id, encoded_tokens, None, False)
 
         labels['finetune'] = torch.tensor(self.labels[cur_id], dtype=torch.float).unsqueeze(0)
 
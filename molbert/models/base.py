@@ -1,7 +1,7 @@
 import logging
 from abc import abstractmethod
 from argparse import Namespace
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 import pytorch_lightning as pl
 import torch
@@ -122,7 +122,7 @@ class FlexibleBertModel(BertPreTrainedModel):
 
 
 class MolbertModel(pl.LightningModule):
-    def __init__(self, args: Namespace = None, **kwargs):
+    def __init__(self, args: Optional[Namespace] = None, **kwargs):
         super().__init__()
 
         if args is not None:
@@ -1,16 +1,18 @@
 import json
 import logging
 import os
-from typing import List, Dict
+from argparse import Namespace
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Dict, Optional, Tuple
 
 import numpy as np
 import torch
-from torchmetrics import MeanSquaredError, AUROC, AveragePrecision, Accuracy, MeanAbsoluteError
-from sklearn.metrics import r2_score
+import torch.nn.functional as F
+from torchmetrics import MeanSquaredError, AUROC, AveragePrecision, Accuracy, MeanAbsoluteError, MetricCollection, R2Score
 from torch import nn
 from torch.utils.data import DataLoader
 
-from molbert.datasets.dataloading import MolbertDataLoader
+from molbert.datasets.dataloading import MolbertDataLoader, collate_prebatched
 from molbert.datasets.finetune import BertFinetuneSmilesDataset
 from molbert.models.base import MolbertModel, MolbertBatchType
 from molbert.tasks.tasks import BaseTask, FinetuneTask
@@ -20,8 +22,118 @@ from molbert.utils.lm_utils import BertConfigExtras
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+TEST_BATCH_SIZE = 1024
+CUDA_GRAPH_WARMUP_ITERS = 3
+# test batches are padded up to a multiple of this, with one CUDA graph captured per padded length
+CUDA_GRAPH_SEQ_LEN_BUCKET = 64
+# GPUs with less memory than this use activation checkpointing when finetuning the full size model
+GRADIENT_CHECKPOINTING_MAX_MEMORY = 16 * 1024 ** 3
+
+CudaGraphType = Tuple[torch.cuda.CUDAGraph, Dict[str, torch.Tensor], Dict[str, torch.Tensor]]
+
+# concurrent.futures waits for pending writes when the interpreter exits
+_metrics_writer = ThreadPoolExecutor(max_workers=1)
+
+
+def write_metrics(metrics: Dict[str, float], metrics_path: str):
+    with open(metrics_path, 'w') as f:
+        json.dump(metrics, f, indent=4)
+
+
+def log_write_metrics_error(future: Future):
+    exception = future.exception()
+    if exception is not None:
+        logger.error('writing test set metrics failed', exc_info=exception)
+
 
 class FinetuneSmilesMolbertModel(MolbertModel):
+    def __init__(self, args: Optional[Namespace] = None, **kwargs):
+        super().__init__(args, **kwargs)
+
+        # captured test forward graphs keyed on the (batch_size, seq_len) of their inputs
+        self._cuda_graphs: Dict[Tuple[int, ...], CudaGraphType] = {}
+        # memory pool shared by these graphs, created on the first capture
+        self._cuda_graph_pool: Any = None
+
+        # registered as a submodule so that the metric states are moved to the model's device
+        self.test_metrics = self.get_metrics()
+
+        self._is_quantized = False
+        self._is_compiled = False
+
+        # host buffers for the test set outputs, allocated at the start of every test epoch
+        self._test_predictions, self._test_labels = self._empty_test_buffers()
+        self._test_offset = 0
+
+    def compile_backbone(self):
+        """
+        Compiles the BERT backbone in place so inductor can fuse the elementwise ops of the attention
+        stack (bias-add, transpose, softmax). The finetune head is left eager to keep its backward stable.
+        The default mode is used instead of 'reduce-overhead' since test steps already replay a CUDA graph.
+        `nn.Module.compile` keeps the state dict keys unchanged. Requires a GPU.
+
+        Only done for testing, where batches are padded to a few fixed shapes. Train and validation batches are
+        trimmed to their longest sequence, so with dynamic=False almost every step would recompile.
+        The backbone stays compiled, so fitting the same model again after testing is slow.
+        """
+        if self._is_compiled or self.hparams.tiny or self.device.type != 'cuda':
+            return
+
+        self.model.bert.compile(dynamic=False)
+        self._is_compiled = True
+
+    def on_fit_start(self):
+        """
+        Trades compute for activation memory on small GPUs, so that larger batches fit
+        and fewer gradient accumulation steps are needed.
+        """
+        if self.hparams.tiny or self.device.type != 'cuda':
+            return
+
+        total_memory = torch.cuda.get_device_properties(self.device).total_memory
+        if total_memory < GRADIENT_CHECKPOINTING_MAX_MEMORY:
+            logger.info(f'Enabling gradient checkpointing, GPU has {total_memory / 1024 ** 3:.1f} GiB of memory')
+            self.enable_gradient_checkpointing()
+
+    def enable_gradient_checkpointing(self):
+        """
+        Uses non-reentrant checkpointing: the reentrant variant drops the gradients of the encoder
+        whenever its input doesn't require grad, e.g. when the embeddings are frozen (freeze_level=-3).
+        """
+        self.model.bert.gradient_checkpointing_enable(gradient_checkpointing_kwargs={'use_reentrant': False})
+
+    def on_test_start(self):
+        # not present in the hparams of older models
+        if self.hparams.get('test_int8'):
+            self.quantize_backbone()
+
+        self.compile_backbone()
+
+    def quantize_backbone(self):
+        """
+        Quantizes the linear layers of the BERT backbone to int8 for test time evaluation.
+        Dynamic quantization is used on the CPU and torchao's weight only quantization on the GPU.
+        This can't be undone, the model can't be trained any further afterwards.
+        """
+        if self._is_quantized:
+            return
+
+        if self.device.type == 'cpu':
+            torch.ao.quantization.quantize_dynamic(self.model.bert, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        else:
+            try:
+                from torchao.quantization import int8_weight_only, quantize_
+            except ImportError:
+                logger.warning('torchao is needed for int8 quantization on the GPU, testing the unquantized model')
+                return
+
+            quantize_(self.model.bert, int8_weight_only())
+
+        # graphs captured before replay the unquantized weights
+        self._cuda_graphs.clear()
+        self._is_quantized = True
+        logger.info('Quantized the BERT backbone to int8')
+
     def get_config(self):
         if not hasattr(self.hparams, 'vocab_size') or not self.hparams.vocab_size:
             self.hparams.vocab_size = 42
@@ -61,6 +173,8 @@ class FinetuneSmilesMolbertModel(MolbertModel):
 
     def load_datasets(self):
         featurizer = SmilesIndexFeaturizer.bert_smiles_index_featurizer(self.hparams.max_seq_length)
+        # not present in the hparams of older models
+        cache_dir = self.hparams.get('token_cache_dir')
 
         train_dataset = BertFinetuneSmilesDataset(
             input_path=self.hparams.train_file,
@@ -69,6 +183,7 @@ class FinetuneSmilesMolbertModel(MolbertModel):
             total_seq_len=self.hparams.max_seq_length,
             label_column=self.hparams.label_column,
             is_same=False,
+            cache_dir=cache_dir,
         )
 
         validation_dataset = BertFinetuneSmilesDataset(
@@ -78,6 +193,7 @@ class FinetuneSmilesMolbertModel(MolbertModel):
             total_seq_len=self.hparams.max_seq_length,
             label_column=self.hparams.label_column,
             is_same=False,
+            cache_dir=cache_dir,
         )
 
         test_dataset = BertFinetuneSmilesDataset(
@@ -87,47 +203,88 @@ class FinetuneSmilesMolbertModel(MolbertModel):
             total_seq_len=self.hparams.max_seq_length,
             label_column=self.hparams.label_column,
             is_same=False,
+            cache_dir=cache_dir,
             inference_mode=True,
         )
 
         return {'train': train_dataset, 'valid': validation_dataset, 'test': test_dataset}
 
+    def get_metrics(self) -> MetricCollection:
+        """
+        All metrics of a mode take the same inputs, so the collection updates them in one call
+        and metrics with the same states (AUROC and AveragePrecision) share them as a compute group.
+        """
+        if self.hparams.mode == 'classification' and self.hparams.output_size > 2:
+            num_classes = self.hparams.output_size
+            return MetricCollection(
+                {
+                    'AUROC': AUROC('multiclass', num_classes=num_classes),
+                    'AveragePrecision': AveragePrecision('multiclass', num_classes=num_classes),
+                    'Accuracy': Accuracy('multiclass', num_classes=num_classes),
+                }
+            )
+
+        if self.hparams.mode == 'classification':
+            return MetricCollection(
+                {
+                    'AUROC': AUROC('binary'),
+                    'AveragePrecision': AveragePrecision('binary'),
+                    # thresholds the probabilities at 0.5, i.e. takes the argmax of the two logits
+                    'Accuracy': Accuracy('binary'),
+                }
+            )
+
+        return MetricCollection(
+            {
+                'MAE': MeanAbsoluteError(),
+                'RMSE': MeanSquaredError(squared=False),
+                'MSE': MeanSquaredError(),
+                'R2': R2Score(),
+            }
+        )
+
     def evaluate_metrics(self, batch_labels, batch_predictions) -> Dict[str, torch.Tensor]:
 
         if self.hparams.mode == 'classification':
-            # transformers convention is to output classification as two neurons.
-            # In order to convert this to a class label we take the argmax.
-            probs = nn.Softmax(dim=1)(batch_predictions)
-            preds = torch.argmax(probs, dim=1).squeeze()
-            probs_of_positive_class = probs[:, 1]
-            batch_labels = batch_labels.long().squeeze()
+            # probabilities are computed in fp32 for numerical stability
+            if self.hparams.output_size == 2:
+                # transformers convention is to output binary classification as two neurons.
+                # softmax(x)[:, 1] == sigmoid(x1 - x0), so the positive class probabilities are computed
+                # from the logit difference in a single pass
+                logit_diff = batch_predictions[:, 1].float() - batch_predictions[:, 0].float()
+                preds = torch.sigmoid(logit_diff)
+            else:
+                preds = torch.softmax(batch_predictions.float(), dim=1)
+            batch_labels = batch_labels.long().reshape(-1)
         else:
             preds = batch_predictions
 
+        # check up front which metrics are defined for these labels instead of catching their errors
+        num_samples = batch_labels.numel()
         if self.hparams.mode == 'classification':
-            metrics = {
-                'AUROC': lambda: AUROC("binary").to(preds.device)(probs_of_positive_class, batch_labels),
-                'AveragePrecision': lambda: AveragePrecision("binary").to(preds.device)(probs_of_positive_class, batch_labels),
-                'Accuracy': lambda: Accuracy("binary").to(preds.device)(preds, batch_labels),
-            }
+            classes = torch.unique(batch_labels)
+            # no metric is defined for labels that the head has no class for
+            num_classes = max(self.hparams.output_size, 2)
+            has_samples = num_samples > 0 and bool(((classes >= 0) & (classes < num_classes)).all())
+            # ranking metrics need at least two classes to be present
+            has_two_classes = has_samples and classes.numel() > 1
+            is_defined = {'AUROC': has_two_classes, 'AveragePrecision': has_two_classes, 'Accuracy': has_samples}
         else:
-            metrics = {
-                'MAE': lambda: MeanAbsoluteError()(preds, batch_labels),
-                'RMSE': lambda: MeanSquaredError(squared=False)(preds, batch_labels),
-                'MSE': lambda: MeanSquaredError()(preds, batch_labels),
-                # sklearn metrics work the other way round metric_fn(y_true, y_pred)
-                'R2': lambda: r2_score(batch_labels.cpu(), preds.cpu()),
-            }
+            is_defined = {'MAE': num_samples > 0, 'RMSE': num_samples > 0, 'MSE': num_samples > 0, 'R2': num_samples > 1}
 
-        out = {}
-        for name, callable_metric in metrics.items():
-            try:
-                out[name] = callable_metric().item()
-            except Exception as e:
-                logger.info(f'unable to calculate {name} metric')
-                logger.info(e)
-                out[name] = np.nan
+        if any(is_defined.values()):
+            self.test_metrics.update(preds, batch_labels)
+
+        # values are left on the device, so that the caller can fetch all of them with a single sync
+        out: Dict[str, torch.Tensor] = {}
+        for name, metric in self.test_metrics.items(keep_base=True):
+            if is_defined[name]:
+                out[name] = metric.compute().float()
+            else:
+                logger.info(f'unable to calculate {name} metric for {num_samples} samples')
+                out[name] = torch.tensor(np.nan, device=batch_predictions.device)
 
+        self.test_metrics.reset()
         return out
 
     def test_step(self, batch: MolbertBatchType, batch_idx: int) -> Dict[str, Dict[str, torch.Tensor]]:  # type: ignore
@@ -141,39 +298,186 @@ class FinetuneSmilesMolbertModel(MolbertModel):
                 - and an array of masks (should be all true) with the length of the true batch size
         """
         (batch_inputs, batch_labels), _ = batch
-        y_hat = self.forward(batch_inputs)
-        outputs = dict(predictions=y_hat, labels=batch_labels)
+
+        # a no-op inside Lightning's test loop, which already runs in inference mode by default,
+        # but keeps view tracking and version counters off when test_step is called elsewhere
+        with torch.inference_mode():
+            if batch_inputs['input_ids'].is_cuda:
+                batch_size = batch_inputs['input_ids'].size(0)
+                y_hat = self._graphed_forward(self._pad_test_batch(batch_inputs))
+                # drop the padded rows, the static graph outputs are copied off the device below
+                y_hat = {k: v[:batch_size] for k, v in y_hat.items()}
+            else:
+                y_hat = self.forward(batch_inputs)
+
+        # the test set outputs are only needed at the end of the epoch, copy them into the host buffers
+        offset, size = self._test_offset, y_hat['finetune'].size(0)
+        self._reserve_test_buffers(offset + size)
+        self._test_predictions[offset:offset + size].copy_(y_hat['finetune'], non_blocking=True)
+        self._test_labels[offset:offset + size].copy_(batch_labels['finetune'], non_blocking=True)
+        self._test_offset += size
+
+        outputs = dict(offset=offset, size=size)
         self.test_step_outputs.append(outputs)
 
-        return outputs
+        return outputs  # type: ignore
+
+    def _pad_test_batch(self, batch_inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """
+        Pads a (possibly trimmed or filtered) test batch to TEST_BATCH_SIZE rows and its sequence length
+        up to the next multiple of CUDA_GRAPH_SEQ_LEN_BUCKET, so that test steps replay one of a few CUDA graphs.
+        Padding to max_seq_length instead would undo the trimming of the data loader, while large test batches
+        are compute bound. Padded positions are masked out, padded rows are all zeros and have to be sliced off
+        the outputs.
+        """
+        batch_size, seq_len = batch_inputs['input_ids'].shape
+        padded_len = -(-seq_len // CUDA_GRAPH_SEQ_LEN_BUCKET) * CUDA_GRAPH_SEQ_LEN_BUCKET
+        padded_len = min(padded_len, self.hparams.max_seq_length)
+        padding = (0, padded_len - seq_len, 0, max(TEST_BATCH_SIZE - batch_size, 0))
+        return {k: F.pad(v, padding) for k, v in batch_inputs.items()}
+
+    def _graphed_forward(self, batch_inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """
+        Performs the forward step by replaying a CUDA graph, capturing it on first use for the given input shape.
+
+        Returns:
+            The static output buffers of the graph, these are overwritten by the next replay
+        """
+        key = tuple(batch_inputs['input_ids'].shape)
+        if key not in self._cuda_graphs:
+            self._cuda_graphs[key] = self._capture_cuda_graph(batch_inputs)
+
+        graph, static_inputs, static_outputs = self._cuda_graphs[key]
+        for k, v in batch_inputs.items():
+            static_inputs[k].copy_(v, non_blocking=True)
+        graph.replay()
+
+        return static_outputs
+
+    def _capture_cuda_graph(self, batch_inputs: Dict[str, torch.Tensor]) -> CudaGraphType:
+        static_inputs = {k: v.clone() for k, v in batch_inputs.items()}
+
+        # cached autocast weight casts would be freed outside of the graph's memory pool
+        autocast = torch.autocast(
+            'cuda',
+            dtype=torch.get_autocast_dtype('cuda'),
+            enabled=torch.is_autocast_enabled(),
+            cache_enabled=False,
+        )
+
+        with autocast:
+            # warmup on a side stream as required before capture
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                for _ in range(CUDA_GRAPH_WARMUP_ITERS):
+                    self.forward(static_inputs)
+            torch.cuda.current_stream().wait_stream(side_stream)
+
+            # the graphs of all padded lengths share a memory pool, this is safe since test steps replay
+            # one graph at a time and copy its outputs off the device before the next replay
+            if self._cuda_graph_pool is None:
+                self._cuda_graph_pool = torch.cuda.graph_pool_handle()
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph, pool=self._cuda_graph_pool):
+                static_outputs = self.forward(static_inputs)
+
+        logger.info(f'Captured CUDA graph for test batches of shape {tuple(static_inputs["input_ids"].shape)}')
+        return graph, static_inputs, static_outputs
+
+    def on_test_epoch_start(self):
+        """
+        Allocates fp32 host buffers for the whole test set, test steps copy their outputs into them.
+        They are fp32 since under mixed precision the forward returns half tensors, while metrics are
+        accumulated in fp32. Pinned memory makes the device to host copies asynchronous.
+        """
+        num_samples = len(self.datasets['test'])
+        pin_memory = torch.cuda.is_available()
+
+        self._test_predictions = torch.empty(
+            (num_samples, self.hparams.output_size), dtype=torch.float32, pin_memory=pin_memory
+        )
+        self._test_labels = torch.empty((num_samples, 1), dtype=torch.float32, pin_memory=pin_memory)
+        self._test_offset = 0
+
+    def _empty_test_buffers(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Empty buffers of the right width, test steps outside of a test epoch grow them as needed
+        """
+        return torch.empty((0, self.hparams.output_size)), torch.empty((0, 1))
+
+    def _reserve_test_buffers(self, num_rows: int):
+        """
+        Grows the test host buffers to hold at least num_rows rows. MolbertDataLoader refills a batch with
+        extra ones when all of its samples are invalid, so an epoch can yield more rows than the dataset size.
+        """
+        capacity = self._test_predictions.size(0)
+        if num_rows <= capacity:
+            return
+
+        if torch.cuda.is_available():
+            # the pending non-blocking copies must land before the filled rows are moved
+            torch.cuda.synchronize()
+
+        capacity = max(num_rows, 2 * capacity)
+        pin_memory = torch.cuda.is_available()
+        for name in ('_test_predictions', '_test_labels'):
+            buffer = getattr(self, name)
+            grown = torch.empty((capacity, buffer.size(1)), dtype=buffer.dtype, pin_memory=pin_memory)
+            grown[:self._test_offset].copy_(buffer[:self._test_offset])
+            setattr(self, name, grown)
 
     def on_test_epoch_end(
         self,
     ) -> Dict[str, Dict[str, torch.Tensor]]:  # type: ignore
-        outputs: List[Dict[str, Dict[str, torch.Tensor]]] = self.test_step_outputs
-        all_predictions = torch.cat([out['predictions']['finetune'] for out in outputs])
-        all_predictions_dict = dict(finetune=all_predictions)
-        all_labels = torch.cat([out['labels']['finetune'] for out in outputs])
-        all_labels_dict = dict(finetune=all_labels)
+        if torch.cuda.is_available():
+            # wait for the non-blocking copies of the test steps
+            torch.cuda.synchronize()
+
+        # invalid samples are dropped by the data loader, so the buffers may not be full
+        all_predictions = self._test_predictions[:self._test_offset]
+        all_predictions_dict = dict(finetune=all_predictions.to(self.device))
+        all_labels = self._test_labels[:self._test_offset]
+        all_labels_dict = dict(finetune=all_labels.to(self.device))
 
         losses = self.evaluate_losses(all_labels_dict, all_predictions_dict)
         loss = torch.sum(torch.stack(list(losses.values())))
 
         # add metrics to the test set evaluation
-        metrics = self.evaluate_metrics(all_labels_dict['finetune'], all_predictions_dict['finetune'])
+        metric_tensors = self.evaluate_metrics(all_labels_dict['finetune'], all_predictions_dict['finetune'])
+
+        # fetch all scalars from the device at once instead of syncing for each of them
+        values = torch.stack([loss, *losses.values(), *metric_tensors.values()]).tolist()
+        loss_value, loss_values = values[0], values[1:len(losses) + 1]
+        metrics = dict(zip(metric_tensors.keys(), values[len(losses) + 1:]))
 
-        tensorboard_logs = {'test_loss': loss, **losses}
+        tensorboard_logs = {'test_loss': loss_value, **dict(zip(losses.keys(), loss_values))}
         metrics_path = os.path.join(os.path.dirname(self.trainer.ckpt_path), 'metrics.json')
-        logger.info('writing test set metrics to', metrics_path)
+        logger.info(f'writing test set metrics to {metrics_path}')
         logger.info(metrics)
-        with open(metrics_path, 'w') as f:
-            json.dump(metrics, f, indent=4)
+        # written in the background while the test run tears down, pending writes are waited for at exit
+        future = _metrics_writer.submit(write_metrics, metrics, metrics_path)
+        future.add_done_callback(log_write_metrics_error)
 
         self.log_dict(tensorboard_logs)
         self.test_step_outputs.clear()
+        self._test_predictions, self._test_labels = self._empty_test_buffers()
         return {'loss': loss, 'metrics': metrics, 'test_loss': loss, 'log': tensorboard_logs}  # type: ignore
 
     def test_dataloader(self) -> DataLoader:
         """ load the test set in one large batch """
         dataset = self.datasets['test']
-        return MolbertDataLoader(dataset, batch_size=1024, num_workers=self.hparams.num_workers)
+
+        if dataset.token_ids is not None:
+            # the dataset's __getitems__ slices each batch out of the token cache instead of collating
+            # TEST_BATCH_SIZE samples. Batching is left to the DataLoader, so Lightning can still swap in
+            # a DistributedSampler
+            return MolbertDataLoader(
+                dataset,
+                batch_size=TEST_BATCH_SIZE,
+                collate_fn=collate_prebatched,
+                num_workers=self.hparams.num_workers,
+            )
+
+        return MolbertDataLoader(dataset, batch_size=TEST_BATCH_SIZE, num_workers=self.hparams.num_workers)
@@ -1,13 +1,19 @@
 import glob
+import json
+import os
 import tempfile
 
+import pandas as pd
+import pytest
 
 from molbert.apps.finetune import FinetuneSmilesMolbertApp
 from molbert.apps.smiles import SmilesMolbertApp
+from molbert.models.finetune import _metrics_writer
 from molbert.tests.utils import data_path, finetune_data_path, smiles_model, smiles_args  # noqa: F401
 
 
-def test_smiles_and_finetune_model(data_path, finetune_data_path, smiles_model):  # noqa: F811
+def pretrain(data_path):  # noqa: F811
+    """ Pretrains a tiny model and returns the path of its checkpoint """
     output_dir = tempfile.mkdtemp()
     raw_args_str = (
         f"--max_seq_length 512 "
@@ -30,7 +36,11 @@ def test_smiles_and_finetune_model(data_path, finetune_data_path, smiles_model):
     raw_args = raw_args_str.split(' ')
     SmilesMolbertApp().run(raw_args)
 
-    ckpt = glob.glob(f'{output_dir}/**/*.ckpt', recursive=True)[0]
+    return glob.glob(f'{output_dir}/**/*.ckpt', recursive=True)[0]
+
+
+def test_smiles_and_finetune_model(data_path, finetune_data_path, smiles_model):  # noqa: F811
+    ckpt = pretrain(data_path)
 
     raw_args_str = (
         f"--max_seq_length 512 "
@@ -49,8 +59,77 @@ def test_smiles_and_finetune_model(data_path, finetune_data_path, smiles_model):
         f"--gpus 0 "
         f"--learning_rate 0.0001 "
         f"--learning_rate_scheduler linear_with_warmup "
+        f"--default_root_dir {tempfile.mkdtemp()} "
         f"--tiny"
     )
     raw_args = raw_args_str.split(' ')
 
     FinetuneSmilesMolbertApp().run(raw_args)
+
+
+@pytest.fixture(scope='module')
+def pretrained_checkpoint():
+    # shared by the tests below, the data_path fixture can't be used in module scope
+    return pretrain(os.path.join(os.path.dirname(__file__), 'test_data.smi'))
+
+
+@pytest.mark.parametrize('use_token_cache', [False, True])
+@pytest.mark.parametrize(
+    'mode,output_size,metric_names',
+    [
+        ('regression', 1, {'MAE', 'RMSE', 'MSE', 'R2'}),
+        ('classification', 2, {'AUROC', 'AveragePrecision', 'Accuracy'}),
+        ('classification', 3, {'AUROC', 'AveragePrecision', 'Accuracy'}),
+    ],
+)
+def test_finetune_and_test_model(
+    pretrained_checkpoint, finetune_data_path, mode, output_size, metric_names, use_token_cache  # noqa: F811
+):
+    # classification labels are binned from the solubility
+    data = pd.read_csv(finetune_data_path)
+    label = data['measured_log_solubility_in_mols_per_litre']
+    if mode == 'classification':
+        data['label'] = pd.qcut(label, output_size, labels=False)
+    else:
+        data['label'] = label
+    input_path = os.path.join(tempfile.mkdtemp(), 'data.csv')
+    data.to_csv(input_path, index=False)
+
+    output_dir = tempfile.mkdtemp()
+    raw_args_str = (
+        f"--max_seq_length 512 "
+        f"--batch_size 16 "
+        f"--max_epochs 1 "
+        f"--num_workers 0 "
+        f"--fast_dev_run 0 "
+        f"--train_file {input_path} "
+        f"--valid_file {input_path} "
+        f"--test_file {input_path} "
+        f"--mode {mode} "
+        f"--output_size {output_size} "
+        f"--pretrained_model_path {pretrained_checkpoint} "
+        f"--label_column label "
+        f"--gpus 0 "
+        f"--learning_rate 0.0001 "
+        f"--learning_rate_scheduler linear_with_warmup "
+        f"--default_root_dir {output_dir} "
+        f"--tiny"
+    )
+    if use_token_cache:
+        raw_args_str += f" --token_cache_dir {tempfile.mkdtemp()}"
+    raw_args = raw_args_str.split(' ')
+
+    trainer = FinetuneSmilesMolbertApp().run(raw_args)
+    results = trainer.test()
+
+    assert results[0]['test_loss'] == pytest.approx(results[0]['finetune'])
+
+    # metrics.json is written in the background, the single writer thread runs this after it
+    _metrics_writer.submit(lambda: None).result()
+    metrics_path = os.path.join(os.path.dirname(trainer.ckpt_path), 'metrics.json')
+    with open(metrics_path) as f:
+        metrics = json.load(f)
+
+    assert set(metrics.keys()) == metric_names
+    # all metrics are defined for these labels
+    assert not any(pd.isna(value) for value in metrics.values())
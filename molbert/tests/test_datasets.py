@@ -1,3 +1,10 @@
+import random
+import tempfile
+
+import torch
+from torch.utils.data import DistributedSampler
+
+from molbert.datasets.dataloading import MolbertDataLoader, collate_prebatched
 from molbert.datasets.finetune import BertFinetuneSmilesDataset
 from molbert.datasets.smiles import BertSmilesDataset
 from molbert.utils.lm_utils import get_seq_lengths
@@ -84,3 +91,106 @@ def test_finetune_dataset(finetune_data_path, featurizer):  # noqa: F811
     assert labels['lm_label_ids'].shape == (max_len,)
     assert labels['unmasked_lm_label_ids'].shape == (max_len,)
     assert labels['finetune'].shape == (1,)
+
+
+def test_finetune_dataset_token_cache(finetune_data_path, featurizer):  # noqa: F811
+    max_len = 64
+    single_seq_len, total_seq_len = get_seq_lengths(max_len, False)
+    kwargs = dict(
+        input_path=finetune_data_path,
+        featurizer=featurizer,
+        single_seq_len=single_seq_len,
+        total_seq_len=total_seq_len,
+        label_column='measured_log_solubility_in_mols_per_litre',
+        inference_mode=True,
+    )
+    dataset = BertFinetuneSmilesDataset(**kwargs)
+    cached_dataset = BertFinetuneSmilesDataset(cache_dir=tempfile.mkdtemp(), **kwargs)
+
+    assert cached_dataset.token_ids is not None
+    assert cached_dataset.token_ids.shape == (len(dataset), total_seq_len)
+
+    for index in range(len(dataset)):
+        (inputs, labels), valid = dataset[index]
+        (cached_inputs, cached_labels), cached_valid = cached_dataset[index]
+
+        assert valid == cached_valid
+        for k in inputs.keys():
+            assert torch.equal(inputs[k], cached_inputs[k])
+        for k in labels.keys():
+            assert torch.equal(labels[k], cached_labels[k])
+
+
+def test_finetune_dataset_token_cache_masking(finetune_data_path, featurizer):  # noqa: F811
+    max_len = 64
+    single_seq_len, total_seq_len = get_seq_lengths(max_len, False)
+    kwargs = dict(
+        input_path=finetune_data_path,
+        featurizer=featurizer,
+        single_seq_len=single_seq_len,
+        total_seq_len=total_seq_len,
+        label_column='measured_log_solubility_in_mols_per_litre',
+    )
+    dataset = BertFinetuneSmilesDataset(**kwargs)
+    cached_dataset = BertFinetuneSmilesDataset(cache_dir=tempfile.mkdtemp(), **kwargs)
+
+    # masking is random, with the same seed the cached tokens have to be masked exactly like the uncached ones
+    for index in range(len(dataset)):
+        random.seed(index)
+        (inputs, labels), valid = dataset[index]
+        random.seed(index)
+        (cached_inputs, cached_labels), cached_valid = cached_dataset[index]
+
+        assert valid == cached_valid
+        for k in inputs.keys():
+            assert torch.equal(inputs[k], cached_inputs[k])
+        for k in labels.keys():
+            assert torch.equal(labels[k], cached_labels[k])
+
+
+def test_finetune_dataset_cached_batch(finetune_data_path, featurizer):  # noqa: F811
+    max_len = 64
+    single_seq_len, total_seq_len = get_seq_lengths(max_len, False)
+    dataset = BertFinetuneSmilesDataset(
+        input_path=finetune_data_path,
+        featurizer=featurizer,
+        single_seq_len=single_seq_len,
+        total_seq_len=total_seq_len,
+        label_column='measured_log_solubility_in_mols_per_litre',
+        inference_mode=True,
+        cache_dir=tempfile.mkdtemp(),
+    )
+
+    indices = [0, 1, 2]
+    (inputs, labels), valids = dataset.__getitems__(indices)
+
+    assert valids.shape == (len(indices),)
+    assert inputs['input_ids'].shape == (len(indices), max_len)
+    assert labels['finetune'].shape == (len(indices), 1)
+
+    for i, index in enumerate(indices):
+        (sample_inputs, sample_labels), _ = dataset[index]
+        assert torch.equal(inputs['input_ids'][i], sample_inputs['input_ids'])
+        assert torch.equal(labels['finetune'][i], sample_labels['finetune'])
+
+
+def test_finetune_dataset_cached_batch_distributed(finetune_data_path, featurizer):  # noqa: F811
+    single_seq_len, total_seq_len = get_seq_lengths(64, False)
+    dataset = BertFinetuneSmilesDataset(
+        input_path=finetune_data_path,
+        featurizer=featurizer,
+        single_seq_len=single_seq_len,
+        total_seq_len=total_seq_len,
+        label_column='measured_log_solubility_in_mols_per_litre',
+        inference_mode=True,
+        cache_dir=tempfile.mkdtemp(),
+    )
+
+    # the sampler Lightning injects under DDP, batches are still fetched through __getitems__
+    sampler: DistributedSampler = DistributedSampler(dataset, num_replicas=2, rank=0, shuffle=False)
+    loader = MolbertDataLoader(dataset, sampler=sampler, batch_size=4, collate_fn=collate_prebatched)
+
+    (inputs, labels), valids = next(iter(loader))
+
+    assert inputs['input_ids'].dim() == 2 and inputs['input_ids'].size(0) == len(valids) <= 4
+    assert labels['finetune'].shape == (len(valids), 1)
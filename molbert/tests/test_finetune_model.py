@@ -1,5 +1,12 @@
+import math
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from molbert.apps.finetune import FinetuneSmilesMolbertApp
 from molbert.datasets.finetune import BertFinetuneSmilesDataset
-from molbert.models.finetune import FinetuneSmilesMolbertModel
+from molbert.models.finetune import TEST_BATCH_SIZE, FinetuneSmilesMolbertModel
 from molbert.tests.utils import (  # noqa: F401
     finetune_args,
     finetune_model,
@@ -34,3 +41,95 @@ def test_load_datasets(finetune_args):  # noqa: F811
     for key in ['train', 'valid', 'test']:
         assert key in datasets.keys()
         assert isinstance(datasets[key], BertFinetuneSmilesDataset)
+
+
+def test_evaluate_metrics(finetune_model):  # noqa: F811
+    labels = torch.randn(10, 1)
+    predictions = labels + 0.1
+
+    metrics = finetune_model.evaluate_metrics(labels, predictions)
+
+    assert set(metrics.keys()) == {'MAE', 'RMSE', 'MSE', 'R2'}
+    assert metrics['MAE'].item() == pytest.approx(0.1, abs=1e-5)
+    assert metrics['MSE'].item() == pytest.approx(0.01, abs=1e-5)
+
+
+def test_evaluate_metrics_single_sample(finetune_model):  # noqa: F811
+    labels = torch.randn(1, 1)
+
+    metrics = finetune_model.evaluate_metrics(labels, labels)
+
+    assert math.isnan(metrics['R2'].item())
+    assert metrics['MAE'].item() == pytest.approx(0.0)
+
+
+def test_evaluate_metrics_multiclass(finetune_args):  # noqa: F811
+    finetune_args.mode, finetune_args.output_size = 'classification', 3
+    model = FinetuneSmilesMolbertModel(finetune_args)
+    labels = torch.tensor([0, 1, 2, 2, 1, 0], dtype=torch.float).unsqueeze(1)
+    # the logits of the true classes are the largest ones
+    predictions = F.one_hot(labels.long().squeeze(1), 3).float()
+
+    metrics = model.evaluate_metrics(labels, predictions)
+
+    assert set(metrics.keys()) == {'AUROC', 'AveragePrecision', 'Accuracy'}
+    assert metrics['AUROC'].item() == pytest.approx(1.0)
+    assert metrics['Accuracy'].item() == pytest.approx(1.0)
+
+
+def test_evaluate_metrics_label_out_of_range(finetune_args):  # noqa: F811
+    finetune_args.mode, finetune_args.output_size = 'classification', 2
+    model = FinetuneSmilesMolbertModel(finetune_args)
+    labels = torch.tensor([0, 1, 2], dtype=torch.float).unsqueeze(1)
+
+    metrics = model.evaluate_metrics(labels, torch.randn(3, 2))
+
+    assert all(math.isnan(value.item()) for value in metrics.values())
+
+
+def test_gradient_checkpointing_with_frozen_embeddings(finetune_model, dummy_model_inputs):  # noqa: F811
+    FinetuneSmilesMolbertApp.freeze_network(finetune_model, freeze_level=-3)
+    finetune_model.enable_gradient_checkpointing()
+    finetune_model.train()
+
+    output = finetune_model(dummy_model_inputs)
+    output['finetune'].sum().backward()
+
+    for layer in finetune_model.model.bert.encoder.layer:
+        assert layer.attention.self.query.weight.grad is not None
+
+
+def test_test_step_grows_buffers(finetune_model, dummy_model_inputs):  # noqa: F811
+    # buffers sized for a single sample, as if the data loader yielded more rows than the dataset has
+    finetune_model._test_predictions = torch.empty(1, finetune_model.hparams.output_size)
+    finetune_model._test_labels = torch.empty(1, 1)
+    finetune_model._test_offset = 0
+    finetune_model.eval()
+
+    for i in range(3):
+        labels = dict(finetune=torch.full((1, 1), float(i)))
+        finetune_model.test_step(((dummy_model_inputs, labels), None), batch_idx=i)
+
+    assert finetune_model._test_offset == 3
+    assert finetune_model._test_labels[:3].flatten().tolist() == [0.0, 1.0, 2.0]
+
+
+def test_test_step_outside_of_test_epoch(finetune_model, dummy_model_inputs):  # noqa: F811
+    finetune_model.eval()
+
+    finetune_model.test_step(((dummy_model_inputs, dict(finetune=torch.ones(1, 1))), None), batch_idx=0)
+
+    assert finetune_model._test_predictions.shape[1:] == (finetune_model.hparams.output_size,)
+    assert finetune_model._test_offset == 1
+
+
+@pytest.mark.parametrize('seq_len,padded_len', [(10, 64), (64, 64), (65, 128)])
+def test_pad_test_batch(finetune_model, seq_len, padded_len):  # noqa: F811
+    finetune_model.hparams.max_seq_length = 100
+    inputs = dict(input_ids=torch.ones(3, seq_len, dtype=torch.long), attention_mask=torch.ones(3, seq_len))
+
+    padded = finetune_model._pad_test_batch(inputs)
+
+    # the bucket is capped at max_seq_length
+    assert padded['input_ids'].shape == (TEST_BATCH_SIZE, min(padded_len, 100))
+    assert padded['attention_mask'][:3, :seq_len].all() and not padded['attention_mask'][:, seq_len:].any()
@@ -35,8 +35,8 @@ setup(
         "pytorch-lightning>=0.8.4",
         "scikit-learn>=0.21.3",
         "scipy>=1.3.1",
-        "transformers>=3.5.1",
-        "torch>=1.4.0",
+        "transformers>=4.35.0",
+        "torch>=2.4.0",
         "torchmetrics>=1.4.0"
     ],
     package_data={"molbert": ["utils/data/*"]},